@@ -55,6 +55,7 @@ class ResourceManager {
                 }
                 self.unzipCurrentDataSet()
                 self.loadMaximumElevationMapForCurrentDataSet()
+                self.loadSeaLevelAliasMapForCurrentDataSet()
             }
             DispatchQueue.main.async {
                 self.loadingObservable.isLoading = false
@@ -79,10 +80,13 @@ class ResourceManager {
         guard let baseURL = currentDataSetDirectoryURL else {
             return ResourceManager.clearTileURL
         }
+        // Tile images that would be the same as the image for a lower sea level aren't bundled,
+        // so find the sea level of the image to use.
+        let imageSeaLevel = aliasedSeaLevel(z: path.z, x: path.x, y: path.y, seaLevel: seaLevel)
         let tileImageURL = baseURL
             .appendingPathComponent("\(path.z)")
             .appendingPathComponent("\(path.x)")
-            .appendingPathComponent("\(currentDataSet)_z\(path.z)x\(path.x)y\(path.y)e\(seaLevel)")
+            .appendingPathComponent("\(currentDataSet)_z\(path.z)x\(path.x)y\(path.y)e\(imageSeaLevel)")
             .appendingPathExtension("png")
         if fileManager.fileExists(atPath: tileImageURL.relativePath) {
             return tileImageURL
@@ -107,6 +111,10 @@ class ResourceManager {
     /// The keys of the dictionary are created by combining the tile coordinates into a single integer.
     private var maximumElevationMap: [UInt64: UInt16] = [:]
 
+    /// This dictionary stores sea level aliases for tiles in the current data set, using the same keys as `maximumElevationMap`.
+    /// Each alias is a range of sea levels that use the tile image for the sea level just below the range.
+    private var seaLevelAliasMap: [UInt64: [(imageSeaLevel: Int, lastSeaLevel: Int)]] = [:]
+
     private var tilesURL: URL? {
         let documentsURL = fileManager.urls(for: .documentDirectory, in: .userDomainMask).first
         return documentsURL?.appendingPathComponent("Tiles", isDirectory: true)
@@ -147,6 +155,41 @@ class ResourceManager {
         return maximumElevationMap[key].map { Int($0) }
     }
 
+    /// Get the sea level of the tile image to show for the given sea level.
+    /// - returns: The sea level of a lower tile image if the image for the given sea level would be the same.
+    ///            Otherwise returns the given sea level.
+    private func aliasedSeaLevel(z: Int, x: Int, y: Int, seaLevel: Int) -> Int {
+        let key = UInt64(z) << 32 + UInt64(x) << 16 + UInt64(y)
+        let alias = seaLevelAliasMap[key]?.first { $0.imageSeaLevel < seaLevel && seaLevel <= $0.lastSeaLevel }
+        return alias?.imageSeaLevel ?? seaLevel
+    }
+
+    private func loadSeaLevelAliasMapForCurrentDataSet() {
+        seaLevelAliasMap = [:]
+        guard let url = currentDataSetDirectoryURL?
+            .appendingPathComponent("\(currentDataSet)_alias")
+            .appendingPathExtension("dat"),
+            let stream = InputStream(url: url) else {
+                return
+        }
+        stream.open()
+        // Each alias is represented by five 16-bit integers.
+        // The first three are the tile coordinates Z, X, and Y, the fourth is the sea level of the tile image to use,
+        // and the fifth is the highest sea level that uses that image.
+        var buffer: [UInt8] = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+        while stream.hasBytesAvailable {
+            guard stream.read(&buffer, maxLength: buffer.count) == buffer.count else {
+                break
+            }
+            let k = buffer.prefix(6).map { UInt64($0) }
+            let key = k[1] << 40 + k[0] << 32 + k[3] << 24 + k[2] << 16 + k[5] << 8 + k[4]
+            let imageSeaLevel = Int(buffer[7]) << 8 + Int(buffer[6])
+            let lastSeaLevel = Int(buffer[9]) << 8 + Int(buffer[8])
+            seaLevelAliasMap[key, default: []].append((imageSeaLevel: imageSeaLevel, lastSeaLevel: lastSeaLevel))
+        }
+        stream.close()
+    }
+
     private func loadMaximumElevationMapForCurrentDataSet() {
         maximumElevationMap = [:]
         guard let url = currentDataSetDirectoryURL?
@@ -0,0 +1,359 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import argparse
+import contextlib
+import numpy
+import srtm_process
+from PIL import Image
+from io import BytesIO, StringIO
+
+# Range of tiles at zoom level 11 used by the benchmarks. It needs the granules N50E004 and N51E004.
+BENCHMARK_RANGE = (1048, 1049, 686, 687)
+
+# Smaller range of tiles at zoom level 11 used to benchmark a whole tileset.
+BENCHMARK_TILESET_RANGE = (1049, 1049, 686, 686)
+
+# Default path of the file with the results that later benchmark runs are compared to.
+BASELINE_PATH = 'benchmark_baseline.json'
+
+# A benchmark is reported as a regression when it takes this much longer than the baseline (0.2 is 20%).
+REGRESSION_THRESHOLD = 0.2
+
+# Spacing in arcseconds and height in meters of each layer of noise in the synthetic terrain.
+# The widest layer forms the coastline and the narrower layers add hills and small bumps.
+TERRAIN_OCTAVES = [(2048, 170), (512, 35), (128, 12), (32, 4), (8, 1.5)]
+
+# Height in meters subtracted from the synthetic terrain, so that part of it is below zero (the sea).
+TERRAIN_SEA_DEPTH = 80
+
+# Number of patches of void values in each synthetic granule.
+VOID_PATCHES = 4
+
+def synthetic_granule(latitude, longitude, seed = 0):
+    '''Returns a SRTM_GRANULE_SIZE x SRTM_GRANULE_SIZE array of synthetic elevation values
+    for the granule at the given latitude and longitude, in the same layout as a .hgt file.
+
+    The terrain is value noise defined on whole-world arcsecond coordinates, so neighboring
+    granules line up, and the rows and columns they share have the same values.
+    Values below zero are sea, and there are a few patches of VOID_RAW values.
+    The same arguments always give the same array.
+    '''
+    size = srtm_process.SRTM_GRANULE_SIZE
+    # Arcsecond coordinates of the rows (from north to south) and columns (from west to east)
+    rows = ((90 - (latitude + 1)) * 3600) + numpy.arange(size)
+    columns = ((longitude + 180) * 3600) + numpy.arange(size)
+    terrain = numpy.zeros((size, size))
+    for (octave, (spacing, height)) in enumerate(TERRAIN_OCTAVES):
+        (row_cells, row_weights) = _noise_coordinates(rows, spacing)
+        (column_cells, column_weights) = _noise_coordinates(columns, spacing)
+        lattice_rows = numpy.arange(row_cells.min(), row_cells.max() + 2)
+        lattice_columns = numpy.arange(column_cells.min(), column_cells.max() + 2)
+        lattice = _lattice_values(lattice_rows[:, None], lattice_columns[None, :], seed * 31 + octave)
+        # Interpolate along the columns first, then along the rows.
+        column_indexes = column_cells - lattice_columns[0]
+        along_columns = (lattice[:, column_indexes] * (1 - column_weights)) + (lattice[:, column_indexes + 1] * column_weights)
+        row_indexes = row_cells - lattice_rows[0]
+        noise = (along_columns[row_indexes] * (1 - row_weights)[:, None]) + (along_columns[row_indexes + 1] * row_weights[:, None])
+        terrain += noise * height
+    granule = numpy.round(terrain - TERRAIN_SEA_DEPTH).astype(numpy.int16)
+    random = numpy.random.default_rng([seed, latitude + 90, longitude + 180])
+    (row_grid, column_grid) = numpy.ogrid[0:size, 0:size]
+    for _ in range(VOID_PATCHES):
+        (center_row, center_column) = random.integers(0, size, 2)
+        (row_radius, column_radius) = random.integers(5, 60, 2)
+        patch = (((row_grid - center_row) / row_radius) ** 2) + (((column_grid - center_column) / column_radius) ** 2) <= 1
+        granule[patch] = srtm_process.VOID_RAW
+    return granule
+
+def _noise_coordinates(coordinates, spacing):
+    '''Returns the lattice cell of each coordinate and the smoothed position within the cell.'''
+    cells = coordinates // spacing
+    fractions = (coordinates % spacing) / spacing
+    return (cells, fractions * fractions * (3 - 2 * fractions))
+
+def _lattice_values(rows, columns, seed):
+    '''Returns pseudo-random values between 0 and 1 for the given lattice points.'''
+    values = (rows.astype(numpy.uint64) * numpy.uint64(374761393)) + (columns.astype(numpy.uint64) * numpy.uint64(668265263))
+    values = values + numpy.uint64(seed * 2654435761 % (2 ** 32))
+    values = (values ^ (values >> numpy.uint64(13))) * numpy.uint64(1274126177)
+    values = values ^ (values >> numpy.uint64(16))
+    return (values & numpy.uint64(0xFFFF)) / 0xFFFF
+
+def write_synthetic_granules(directory, min_tile_x, max_tile_x, min_tile_y, max_tile_y, seed = 0):
+    '''Writes a synthetic .hgt file (big-endian 16-bit integers) to the given directory
+    for each granule needed by the given range of tiles at zoom level 11.'''
+    for (latitude, longitude) in sorted(srtm_process.range_granules(min_tile_x, max_tile_x, min_tile_y, max_tile_y)):
+        granule_path = os.path.join(directory, srtm_process.srtm_granule_path(latitude, longitude))
+        synthetic_granule(latitude, longitude, seed).astype('>i2').tofile(granule_path)
+
+def write_zipped_granule(directory, latitude, longitude):
+    '''Zips the .hgt file of a granule in the current directory into the given directory,
+    with the file name used on the NASA Earthdata Search site.'''
+    os.makedirs(directory, exist_ok = True)
+    zip_path = os.path.join(directory, srtm_process.srtm_granule_zip_path(latitude, longitude))
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.write(srtm_process.srtm_granule_path(latitude, longitude))
+
+def measure(function, repeat, setup = None, number = 1):
+    '''Times the function repeat times, calling setup (if given) before each time without timing it.
+    Each time, the function is called number times in a row, which makes the times of quick functions
+    more stable. Returns a dictionary with the fastest and median times per call in seconds.'''
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return {'seconds': min(times), 'median_seconds': float(numpy.median(times))}
+
+def benchmark_tiles(min_tile_x, max_tile_x, min_tile_y, max_tile_y):
+    '''Returns one tile at each zoom level to benchmark, preferring tiles near the middle of the range
+    that will be resampled (that is, not completely above sea level or solid).'''
+    (arr, arr_lat, arr_lon) = srtm_process.load_srtm_data_needed(*_z9_range(min_tile_x, max_tile_x, min_tile_y, max_tile_y), 9)
+    pyramid = srtm_process.ElevationPyramid(arr)
+    chosen = {}
+    for tile in srtm_process.tileset_tiles(min_tile_x, max_tile_x, min_tile_y, max_tile_y):
+        (x, y, z, clear_px) = tile
+        (tile_class, _) = srtm_process.classify_tile(x, y, z, pyramid, arr_lat, arr_lon, clear_px)
+        if tile_class == srtm_process.TILE_MIXED:
+            chosen.setdefault(z, []).append(tile)
+    return [tiles[len(tiles) // 2] for (z, tiles) in sorted(chosen.items())]
+
+def _z9_range(min_tile_x, max_tile_x, min_tile_y, max_tile_y):
+    return (min_tile_x // 4, max_tile_x // 4, min_tile_y // 4, max_tile_y // 4)
+
+def run_benchmarks(directory, repeat = 5, pixel_samples = 10000):
+    '''Runs the benchmarks in the given work directory, which must contain the granules
+    written by write_synthetic_granules. Everything the benchmarks create is kept inside that directory.
+    Returns a dictionary of results keyed by benchmark name.'''
+    directory = os.path.abspath(directory)
+    results = {}
+    with working_directory(directory):
+        (latitude, longitude) = min(srtm_process.range_granules(*BENCHMARK_RANGE))
+        results['process_srtm_granule'] = measure(lambda: srtm_process.process_srtm_granule(latitude, longitude), repeat)
+        write_zipped_granule('zipped', latitude, longitude)
+        os.chdir('zipped')
+        try:
+            results['process_srtm_granule_zip'] = measure(lambda: srtm_process.process_srtm_granule(latitude, longitude),
+                                                          repeat)
+        finally:
+            os.chdir('..')
+        z9_range = _z9_range(*BENCHMARK_RANGE)
+        results['load_srtm_data_needed_cold'] = measure(
+            lambda: srtm_process.load_srtm_data_needed(*z9_range, 9, cache = srtm_process.GranuleCache(0)), repeat)
+        warm_cache = srtm_process.GranuleCache(srtm_process.GRANULE_CACHE_BYTES)
+        srtm_process.load_srtm_data_needed(*z9_range, 9, cache = warm_cache)
+        results['load_srtm_data_needed_warm'] = measure(
+            lambda: srtm_process.load_srtm_data_needed(*z9_range, 9, cache = warm_cache), repeat, number = 10)
+        (arr, arr_lat, arr_lon) = srtm_process.load_srtm_data_needed(*z9_range, 9, cache = warm_cache)
+        pyramid = srtm_process.ElevationPyramid(arr)
+        # Pixels at zoom level 13 spread over the range of tiles, as fractional tile coordinates
+        tile_size = srtm_process.TILE_SIZE
+        pixels = [((BENCHMARK_RANGE[0] * 4) + ((index * 7919) % (8 * tile_size)) / tile_size,
+                   (BENCHMARK_RANGE[2] * 4) + ((index * 104729) % (8 * tile_size)) / tile_size)
+                  for index in range(pixel_samples)]
+        def pixel_elevations():
+            for (pixel_x, pixel_y) in pixels:
+                srtm_process.pixel_elevation(pixel_x, pixel_y, 13, arr, arr_lat, arr_lon)
+        results['pixel_elevation_x{0}'.format(pixel_samples)] = measure(pixel_elevations, repeat)
+        store = srtm_process.DirectoryTileStore('benchmark_tiles')
+        for (x, y, z, clear_px) in benchmark_tiles(*BENCHMARK_RANGE):
+            def create_tile():
+                srtm_process.create_tile_images(x, y, z, arr, arr_lat, arr_lon, 'benchmark', overwrite = True,
+                                                clear_px = clear_px, solid_index = srtm_process.SolidTileIndex(),
+                                                alias_index = srtm_process.SeaLevelAliasIndex(), store = store,
+                                                pyramid = pyramid)
+            results['create_tile_images_z{0}'.format(z)] = measure(create_tile, repeat, number = 10)
+        # The tileset is created in the work directory, and only its own directory is removed between runs.
+        tiles_directory = os.path.join(directory, srtm_process.TILES_DIRECTORY)
+        def remove_tileset():
+            shutil.rmtree(os.path.join(tiles_directory, 'benchmark'), ignore_errors = True)
+            srtm_process.granule_cache.clear()
+        results['create_srtm_tileset'] = measure(
+            lambda: srtm_process.create_srtm_tileset(*BENCHMARK_TILESET_RANGE, 'benchmark', manifest_path = None,
+                                                     store_path = tiles_directory),
+            repeat, setup = remove_tileset)
+    return results
+
+@contextlib.contextmanager
+def working_directory(directory):
+    '''Changes the current directory to the given directory inside a with statement.'''
+    original_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(original_directory)
+
+def tileset_digest(dataset, root = srtm_process.TILES_DIRECTORY):
+    '''Returns a SHA-1 digest of every tile image and index file of a tileset,
+    which changes if any part of the output changes.'''
+    digest = hashlib.sha1()
+    store = srtm_process.DirectoryTileStore(root)
+    index_paths = [store.index_path(dataset, index_class.NAME)
+                   for index_class in (srtm_process.SolidTileIndex, srtm_process.SeaLevelAliasIndex)]
+    paths = sorted(path for path in glob_files(os.path.join(root, dataset)) if path not in index_paths) + index_paths
+    for path in paths:
+        if os.path.exists(path):
+            digest.update(os.path.relpath(path, root).encode())
+            with open(path, 'rb') as output_file:
+                digest.update(output_file.read())
+    return digest.hexdigest()
+
+def glob_files(directory):
+    for (directory_path, _, file_names) in os.walk(directory):
+        for file_name in file_names:
+            yield os.path.join(directory_path, file_name)
+
+def reference_elevations(x, y, z, arr, arr_lat, arr_lon):
+    '''Returns the elevation of every pixel of a tile, calculated separately with pixel_elevation.'''
+    tile_size = srtm_process.TILE_SIZE
+    reference = numpy.empty((tile_size, tile_size))
+    for row in range(tile_size):
+        for column in range(tile_size):
+            reference[row, column] = srtm_process.pixel_elevation(x + (column / tile_size), y + (row / tile_size),
+                                                                  z, arr, arr_lat, arr_lon)
+    return reference
+
+def check_tile_masks(x, y, z, clear_px, arr, arr_lat, arr_lon, pyramid, grids = None, reference = None):
+    '''Creates the images for a tile and compares the area below each sea level
+    with the area found using pixel_elevation for every pixel.
+    If grids (an ElevationGridSet) is given, the images are created from the grids,
+    as create_srtm_tileset does with a grid directory, instead of from the arcsecond array.
+    The pixel_elevation values can be given as reference if they have already been calculated
+    with reference_elevations.
+
+    Pixels whose elevation is within ELEVATION_GRID_TOLERANCE of a whole number of meters
+    are not compared, since rounding decides which side of the sea level they are on.
+
+    Returns:
+    int: The number of pixels that don't match, over all sea levels.
+    '''
+    store = srtm_process.DirectoryTileStore('benchmark_check_tiles')
+    solid_index = srtm_process.SolidTileIndex()
+    alias_index = srtm_process.SeaLevelAliasIndex()
+    srtm_process.create_tile_images(x, y, z, arr, arr_lat, arr_lon, 'check', overwrite = True, clear_px = clear_px,
+                                    solid_index = solid_index, alias_index = alias_index, store = store, pyramid = pyramid,
+                                    pixel_elevations = grids.tile_grid(x, y, z) if grids is not None else None)
+    if reference is None:
+        reference = reference_elevations(x, y, z, arr, arr_lat, arr_lon)
+    compared = numpy.abs(reference - numpy.round(reference)) > srtm_process.ELEVATION_GRID_TOLERANCE
+    visible = srtm_process.clear_tile_pixels(numpy.ones(reference.shape, dtype = bool), clear_px, False)
+    solid_sea_level = solid_index.lookup(z, x, y)
+    mismatches = 0
+    for sea_level in range(1, 101):
+        # The image for a sea level shows the pixels at or below the sea level below it.
+        expected = (reference <= sea_level - 1) & visible
+        if solid_sea_level is not None and sea_level >= solid_sea_level:
+            actual = numpy.ones(reference.shape, dtype = bool)
+        else:
+            image_bytes = store.read_image('check', z, x, y, alias_index.image_sea_level(z, x, y, sea_level))
+            if image_bytes is None:
+                actual = numpy.zeros(reference.shape, dtype = bool)
+            else:
+                actual = numpy.array(Image.open(BytesIO(image_bytes))) == 1
+        mismatches += int(numpy.count_nonzero((expected != actual) & compared))
+    shutil.rmtree('benchmark_check_tiles', ignore_errors = True)
+    return mismatches
+
+def run_checks(directory):
+    '''Runs the correctness checks in the given work directory (see run_benchmarks).
+    Returns a dictionary with the number of mismatched pixels for each checked tile, both resampled directly and
+    from elevation grids made by build_elevation_grids, the largest difference between
+    the grids and pixel_elevation at each zoom level, and the digest of the tileset
+    created by run_benchmarks.'''
+    with working_directory(directory):
+        z9_range = _z9_range(*BENCHMARK_RANGE)
+        (arr, arr_lat, arr_lon) = srtm_process.load_srtm_data_needed(*z9_range, 9)
+        pyramid = srtm_process.ElevationPyramid(arr)
+        grids = srtm_process.build_elevation_grids(*z9_range, arr, arr_lat, arr_lon, tileset_range = BENCHMARK_RANGE,
+                                                   pyramid = pyramid)
+        mask_mismatches = {}
+        grid_mask_mismatches = {}
+        for (x, y, z, clear_px) in benchmark_tiles(*BENCHMARK_RANGE):
+            tile = 'z{0}x{1}y{2}'.format(z, x, y)
+            reference = reference_elevations(x, y, z, arr, arr_lat, arr_lon)
+            mask_mismatches[tile] = check_tile_masks(x, y, z, clear_px, arr, arr_lat, arr_lon, pyramid,
+                                                     reference = reference)
+            grid_mask_mismatches[tile] = check_tile_masks(x, y, z, clear_px, arr, arr_lat, arr_lon, pyramid, grids,
+                                                          reference)
+        grid_errors = {'z{0}'.format(z): float(error)
+                       for (z, error) in sorted(srtm_process.elevation_grids_error(grids, arr, arr_lat, arr_lon).items())}
+        return {'mask_mismatches': mask_mismatches, 'grid_mask_mismatches': grid_mask_mismatches,
+                'grid_errors': grid_errors, 'tileset_digest': tileset_digest('benchmark')}
+
+def compare_to_baseline(results, checks, baseline, threshold = REGRESSION_THRESHOLD):
+    '''Prints the results next to the baseline and returns a list of problems:
+    benchmarks slower than the baseline by more than the threshold, tiles whose masks
+    don't match pixel_elevation, elevation grids further from pixel_elevation than
+    ELEVATION_GRID_TOLERANCE, and a tileset digest different from the baseline's.'''
+    problems = []
+    baseline_results = baseline.get('results', {}) if baseline is not None else {}
+    for (name, result) in results.items():
+        line = '{0:>30}: {1:9.4f} s'.format(name, result['seconds'])
+        if name in baseline_results:
+            change = (result['seconds'] / baseline_results[name]['seconds']) - 1
+            line += '  {0:+7.1%}'.format(change)
+            if change > threshold:
+                line += '  REGRESSION'
+                problems.append('{0} is {1:.1%} slower than the baseline'.format(name, change))
+        print(line)
+    for (tile, mismatches) in checks['mask_mismatches'].items():
+        if mismatches > 0:
+            problems.append('{0}: {1} pixels don\'t match pixel_elevation'.format(tile, mismatches))
+    for (tile, mismatches) in checks['grid_mask_mismatches'].items():
+        if mismatches > 0:
+            problems.append('{0}: {1} pixels created from the elevation grids don\'t match pixel_elevation'.format(
+                tile, mismatches))
+    for (z, error) in checks['grid_errors'].items():
+        if error > srtm_process.ELEVATION_GRID_TOLERANCE:
+            problems.append('{0}: The elevation grids differ from pixel_elevation by up to {1} meters'.format(z, error))
+    if baseline is not None and baseline.get('checks', {}).get('tileset_digest') not in (None, checks['tileset_digest']):
+        problems.append('The tileset output is different from the baseline')
+    return problems
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description = 'Benchmarks srtm_process.py using synthetic SRTM granules.')
+    parser.add_argument('--baseline', default = BASELINE_PATH, help = 'Path of the baseline results file.')
+    parser.add_argument('--save', action = 'store_true', help = 'Save the results as the new baseline.')
+    parser.add_argument('--threshold', type = float, default = REGRESSION_THRESHOLD,
+                        help = 'Fraction by which a benchmark may be slower than the baseline.')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'Number of times each benchmark is run.')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for the synthetic terrain.')
+    options = parser.parse_args(arguments)
+    baseline_path = os.path.abspath(options.baseline)
+    baseline = None
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('seed') != options.seed:
+            print('The baseline uses a different seed, so it is ignored')
+            baseline = None
+    work_directory = tempfile.mkdtemp(prefix = 'srtm_benchmark_')
+    try:
+        write_synthetic_granules(work_directory, *BENCHMARK_RANGE, seed = options.seed)
+        # Hide the progress messages printed by srtm_process
+        with contextlib.redirect_stdout(StringIO()):
+            results = run_benchmarks(work_directory, options.repeat)
+            checks = run_checks(work_directory)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors = True)
+    problems = compare_to_baseline(results, checks, baseline, options.threshold)
+    if options.save:
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump({'seed': options.seed, 'results': results, 'checks': checks}, baseline_file, indent = 2)
+        print('Saved the baseline to {0}'.format(baseline_path))
+    for problem in problems:
+        print(problem)
+    return 1 if len(problems) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
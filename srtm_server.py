@@ -0,0 +1,263 @@
+import os
+import sys
+import json
+import math
+import asyncio
+import hashlib
+import argparse
+import numpy
+import srtm_process
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Directory of the compact elevation grids served by default.
+GRID_STORE_DIRECTORY = 'SeaLevel/Grids'
+
+# Number of tile elevation grids (128 KB each) kept in memory by the server.
+TILE_GRID_CACHE_SIZE = 2048
+
+# zlib compression level of the tile images rendered by the server.
+# Lower than PNG_COMPRESS_LEVEL, since the images are created on every request that isn't cached by the client.
+SERVER_COMPRESS_LEVEL = 6
+
+# Number of threads that render tile images. Comparing the grids and compressing
+# the images mostly happen outside of the global interpreter lock, so these run in parallel.
+RENDER_THREADS = 4
+
+# Number of hundredths of a meter stored for elevations that are never below any sea level.
+# Sea levels go up to 100 meters, so any elevation above 100 meters is stored as this value.
+NEVER_COVERED = 10100
+
+def compact_elevation_grid(grid):
+    '''Converts an elevation grid to hundredths of a meter, rounded up, as 16-bit integers.
+
+    A pixel is below a sea level when its elevation is less than or equal to the sea level,
+    and for sea levels that are a whole number of hundredths of a meter, that's the same as when
+    the rounded-up value is less than or equal to the sea level in hundredths of a meter.
+    So the compact grid gives exactly the same images as the full grid for those sea levels,
+    in a quarter of the space. Pixels outside of the tileset range, which are NaN
+    (see build_elevation_grids), are never covered.
+    '''
+    compact = numpy.empty(grid.shape, dtype = numpy.uint16)
+    # Convert a band of rows at a time, since the full grid may be memory-mapped and much larger than memory.
+    for row in range(0, grid.shape[0], srtm_process.TILE_SIZE):
+        band = numpy.ceil(numpy.asarray(grid[row:(row + srtm_process.TILE_SIZE)]) * 100)
+        band[numpy.isnan(band)] = NEVER_COVERED
+        compact[row:(row + srtm_process.TILE_SIZE)] = numpy.clip(band, 0, NEVER_COVERED)
+    return compact
+
+def build_grid_store(dataset, min_tile_x, max_tile_x, min_tile_y, max_tile_y, directory = GRID_STORE_DIRECTORY,
+                     grid_directory = None):
+    '''Saves compact elevation grids for a tileset in the given directory, for the tile server.
+
+    The grids are made from the elevation grids saved in grid_directory by create_srtm_tileset,
+    if there are any for the dataset that were made from the current SRTM granules.
+    Otherwise the SRTM data is loaded and the elevation grids are calculated first.
+
+    Parameters:
+    dataset (str): Name of the dataset.
+    min_tile_x, max_tile_x, min_tile_y, max_tile_y (int): Range of tiles at zoom level 11.
+    directory (str): Directory to save the compact grids in.
+    grid_directory (str): Directory of elevation grids saved by ElevationGridSet.save.
+    '''
+    grid_range = (min_tile_x // 4, max_tile_x // 4, min_tile_y // 4, max_tile_y // 4)
+    sources = srtm_process.tileset_sources(min_tile_x, max_tile_x, min_tile_y, max_tile_y)
+    grids = srtm_process.ElevationGridSet.load(grid_directory, dataset) if grid_directory is not None else None
+    tileset_range = (min_tile_x, max_tile_x, min_tile_y, max_tile_y)
+    if grids is None or not grids.matches(grid_range, sources, tileset_range):
+        (arr, arr_lat, arr_lon) = srtm_process.load_srtm_data_needed(*grid_range, 9)
+        grids = srtm_process.build_elevation_grids(*grid_range, arr, arr_lat, arr_lon, tileset_range = tileset_range)
+    compact_grids = {z: compact_elevation_grid(grid) for (z, grid) in grids.grids.items()}
+    srtm_process.ElevationGridSet(grids.min_tile_x, grids.max_tile_x, grids.min_tile_y, grids.max_tile_y,
+                                  grids.min_z, compact_grids, sources, grids.tileset_range).save(directory, dataset)
+    # The range at zoom level 11 is needed to erase the parts of the zoom level 9 and 10 tiles outside of the tileset.
+    with open('{0}/{1}_range.json'.format(directory, dataset), 'w') as range_file:
+        json.dump([min_tile_x, max_tile_x, min_tile_y, max_tile_y], range_file)
+
+class GridStore:
+    '''The compact elevation grids in a directory, with a least-recently-used cache
+    of the grids of individual tiles.'''
+
+    def __init__(self, directory = GRID_STORE_DIRECTORY, cache_size = TILE_GRID_CACHE_SIZE):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._datasets = {}
+        self._tile_grids = OrderedDict()
+
+    def dataset(self, dataset):
+        '''Returns a (grids, clear_px by tile, version) tuple for the dataset, or None if it has no grids
+        or no range file (see build_grid_store). The version changes whenever the grids are saved again.'''
+        if dataset not in self._datasets:
+            grids = srtm_process.ElevationGridSet.load(self.directory, dataset)
+            if grids is None:
+                return None
+            try:
+                with open('{0}/{1}_range.json'.format(self.directory, dataset)) as range_file:
+                    tile_range = json.load(range_file)
+            except IOError:
+                return None
+            clear_px = {tile[:3]: tile[3] for tile in srtm_process.tileset_tiles(*tile_range) if tile[3] is not None}
+            metadata_stat = os.stat('{0}/{1}_grids.json'.format(self.directory, dataset))
+            self._datasets[dataset] = (grids, clear_px, '{0}-{1}'.format(metadata_stat.st_mtime_ns, metadata_stat.st_size))
+        return self._datasets[dataset]
+
+    def tile_grid(self, dataset, z, x, y):
+        '''Returns the compact elevation grid of a tile, or None if the tile isn't in the dataset.'''
+        key = (dataset, z, x, y)
+        tile_grid = self._tile_grids.get(key)
+        if tile_grid is not None:
+            self._tile_grids.move_to_end(key)
+            return tile_grid
+        (grids, _, _) = self.dataset(dataset)
+        tile_grid = grids.tile_grid(x, y, z)
+        if tile_grid is None:
+            return None
+        # Copy the tile out of the memory-mapped file, so that later requests don't read the disk.
+        tile_grid = numpy.array(tile_grid)
+        self._tile_grids[key] = tile_grid
+        if len(self._tile_grids) > self.cache_size:
+            self._tile_grids.popitem(last = False)
+        return tile_grid
+
+def sea_level_threshold(sea_level):
+    '''Returns the highest value in a compact elevation grid that is below the given sea level.
+
+    As with the images created by create_tile_images, the image for sea level s
+    shows the pixels whose elevation is less than or equal to s - 1, so for whole-number
+    sea levels the image shows the same pixels as the pre-rendered image.
+    Fractional sea levels are rounded down to a hundredth of a meter.
+    '''
+    # Round first, so that a sea level like 2.3 isn't rounded down to 229.99999 hundredths of a meter.
+    return math.floor(round((sea_level - 1) * 100, 6))
+
+def render_tile(tile_grid, sea_level, clear_px = None, compress_level = SERVER_COMPRESS_LEVEL):
+    '''Returns the bytes of the tile image for a sea level, which may be fractional. See sea_level_threshold.'''
+    fill = srtm_process.clear_tile_pixels(tile_grid <= sea_level_threshold(sea_level), clear_px, False)
+    return srtm_process.encode_tile_image(fill, compress_level)
+
+def tile_etag(dataset, z, x, y, sea_level, version):
+    '''Returns the ETag of a tile image, which changes if the grids, the sea level or the image format change.'''
+    # Sea levels that show the same pixels share an ETag.
+    key = [dataset, z, x, y, sea_level_threshold(sea_level), version, srtm_process.OVERLAY_COLOR, SERVER_COMPRESS_LEVEL]
+    return '"{0}"'.format(hashlib.sha1(json.dumps(key).encode()).hexdigest())
+
+class TileServer:
+    '''An HTTP server that renders tile images from a GridStore on request.
+
+    Tile images are at /<dataset>/<z>/<x>/<y>/<sea level>.png, and the sea level
+    can be fractional (for example /newYorkSRTM/12/1206/1539/2.5.png).
+    Responses have an ETag, so clients can revalidate cached images with If-None-Match.
+    '''
+
+    def __init__(self, store, render_threads = RENDER_THREADS):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers = render_threads)
+
+    async def serve(self, host = '127.0.0.1', port = 8000):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print('Serving tiles from {0} at http://{1}:{2}/'.format(self.store.directory, host, port), flush = True)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    header_line = await reader.readline()
+                    if header_line in (b'\r\n', b'\n', b''):
+                        break
+                    (name, _, value) = header_line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    await self.respond(writer, 400, b'Bad request')
+                    break
+                (method, path, version) = parts
+                if method not in ('GET', 'HEAD'):
+                    await self.respond(writer, 405, b'Method not allowed')
+                    continue
+                try:
+                    (status, body, response_headers) = await self.tile_response(path, headers)
+                except Exception as error:
+                    # Answer the request with an error instead of dropping the connection without a response.
+                    print('Failed to respond to {0}: {1!r}'.format(path, error), flush = True)
+                    (status, body, response_headers) = (500, b'Internal server error', {})
+                await self.respond(writer, status, body if method == 'GET' else b'', response_headers,
+                                   content_length = len(body))
+                if version == 'HTTP/1.0' or headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def tile_response(self, path, headers):
+        '''Returns the (status, body, headers) of the response to a request for the given path.'''
+        parts = path.split('?')[0].strip('/').split('/')
+        try:
+            (dataset, z, x, y) = (parts[0], int(parts[1]), int(parts[2]), int(parts[3]))
+            if len(parts) != 5 or not parts[4].endswith('.png'):
+                raise ValueError()
+            sea_level = float(parts[4][:-len('.png')])
+            if not math.isfinite(sea_level):
+                raise ValueError()
+        except (ValueError, IndexError):
+            return (404, b'Not found', {})
+        # Looking up the grids is quick and happens on the event loop, so the cache doesn't need a lock.
+        # Only rendering happens on the executor's threads.
+        dataset_grids = self.store.dataset(dataset)
+        if dataset_grids is None:
+            return (404, b'Unknown dataset', {})
+        (_, clear_px, version) = dataset_grids
+        etag = tile_etag(dataset, z, x, y, sea_level, version)
+        response_headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if headers.get('if-none-match') == etag:
+            return (304, b'', response_headers)
+        tile_grid = self.store.tile_grid(dataset, z, x, y)
+        if tile_grid is None:
+            return (404, b'Tile not in dataset', {})
+        loop = asyncio.get_running_loop()
+        image_bytes = await loop.run_in_executor(self.executor, render_tile, tile_grid, sea_level, clear_px.get((x, y, z)))
+        response_headers['Content-Type'] = 'image/png'
+        return (200, image_bytes, response_headers)
+
+    async def respond(self, writer, status, body, headers = None, content_length = None):
+        reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                   500: 'Internal Server Error'}
+        lines = ['HTTP/1.1 {0} {1}'.format(status, reasons[status])]
+        for (name, value) in (headers or {}).items():
+            lines.append('{0}: {1}'.format(name, value))
+        lines.append('Content-Length: {0}'.format(content_length if content_length is not None else len(body)))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description = 'Serves sea level tile images rendered from elevation grids.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    build_parser = subparsers.add_parser('build', help = 'Save compact elevation grids for tilesets in range.txt.')
+    build_parser.add_argument('datasets', nargs = '+', help = 'Names of the tilesets in range.txt.')
+    build_parser.add_argument('--directory', default = GRID_STORE_DIRECTORY, help = 'Directory to save the grids in.')
+    build_parser.add_argument('--grid-directory', help = 'Directory of existing elevation grids to convert.')
+    serve_parser = subparsers.add_parser('serve', help = 'Serve tile images.')
+    serve_parser.add_argument('--directory', default = GRID_STORE_DIRECTORY, help = 'Directory of the compact grids.')
+    serve_parser.add_argument('--host', default = '127.0.0.1')
+    serve_parser.add_argument('--port', type = int, default = 8000)
+    options = parser.parse_args(arguments)
+    if options.command == 'build':
+        tile_ranges = {range_tuple[0]: range_tuple[1:] for range_tuple in srtm_process.ranges()}
+        for dataset in options.datasets:
+            if dataset not in tile_ranges:
+                print('{0} is not in range.txt'.format(dataset))
+                return 1
+            build_grid_store(dataset, *tile_ranges[dataset], options.directory, options.grid_directory)
+            print('Saved grids for {0}'.format(dataset))
+    else:
+        asyncio.run(TileServer(GridStore(options.directory)).serve(options.host, options.port))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))